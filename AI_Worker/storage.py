@@ -0,0 +1,302 @@
+"""
+Image storage for the AI worker.
+
+Uploaded images are read by their ImageStorageKey and annotated images are
+written through a storage backend, so workers do not need the shared ./uploads
+volume. ImageStore adds a bounded local disk cache, read-ahead for queued jobs
+and parallel uploads on top of any backend.
+"""
+import os
+import hashlib
+import logging
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Temporary download files older than this are left over from a crashed process
+STALE_TEMP_SECONDS = 3600
+
+
+def temp_path_for(path):
+    """
+    Temporary file name unique across processes and threads sharing a directory
+    """
+    return f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+
+
+class LocalStorage:
+    """
+    Keys are file paths, relative to base_dir unless absolute
+    """
+    def __init__(self, base_dir='.'):
+        self.base_dir = base_dir
+
+    def get_local_path(self, key):
+        return key if os.path.isabs(key) else os.path.join(self.base_dir, key)
+
+    def read_bytes(self, key):
+        with open(self.get_local_path(key), 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, key, data):
+        path = self.get_local_path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Write to a temporary file first so readers never see a partial image
+        temp_path = temp_path_for(path)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def delete(self, key):
+        path = self.get_local_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class S3Storage:
+    """
+    Keys are object keys in an S3-compatible bucket (AWS S3, MinIO, ...).
+    Credentials are read by boto3 from AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY.
+    """
+    def __init__(self, bucket, endpoint_url=None, region=None):
+        try:
+            import boto3
+        except ImportError:
+            raise Exception("boto3 is required for the S3 storage backend (pip install boto3)")
+        self.bucket = bucket
+        # boto3 clients are thread-safe, so one client serves the prefetch and upload pools
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+
+    def get_local_path(self, key):
+        return None
+
+    def read_bytes(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def write_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def ensure_bucket(self):
+        """
+        Create the bucket if it does not exist (for local stand-ins)
+        """
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except Exception:
+            logger.info(f"Creating bucket {self.bucket}")
+            self.client.create_bucket(Bucket=self.bucket)
+
+
+class ImageStore:
+    """
+    Storage front end used by the worker: bounded LRU disk cache, asynchronous
+    read-ahead and parallel uploads on top of a LocalStorage or S3Storage backend
+    """
+    def __init__(self, backend, cache_dir=None, cache_max_bytes=0, prefetch_workers=2, upload_workers=4):
+        self.backend = backend
+        self.cache_dir = cache_dir if cache_max_bytes > 0 else None
+        self.cache_max_bytes = cache_max_bytes
+        self.lock = threading.Lock()
+        self.cache_index = OrderedDict()  # cache file path -> size in bytes, least recently used first
+        self.cache_bytes = 0
+        self.inflight = {}  # key -> Future for downloads in progress
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='prefetch')
+        self.upload_executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix='upload')
+        self.pending_uploads = []
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.load_cache_index()
+            logger.info(f"Image cache at {self.cache_dir} (max {cache_max_bytes // (1024 * 1024)} MB, "
+                        f"{len(self.cache_index)} files / {self.cache_bytes // (1024 * 1024)} MB reused)")
+
+    def load_cache_index(self):
+        """
+        Index files left in the cache directory by a previous run, oldest first, and trim to the limit.
+        Stale partial downloads from a crashed run are removed; recent ones may belong to a live process.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if '.tmp-' in entry.name:
+                if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self.cache_index[path] = size
+            self.cache_bytes += size
+        with self.lock:
+            self.evict()
+
+    def cache_path(self, key):
+        extension = os.path.splitext(key)[1]
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    def ensure_cached(self, key):
+        """
+        Download a key into the cache if it is not there yet and return its cache path.
+        Concurrent requests for the same key share one download.
+        """
+        path = self.cache_path(key)
+        with self.lock:
+            if path in self.cache_index:
+                self.cache_index.move_to_end(path)
+                return path
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            data = self.backend.read_bytes(key)
+            temp_path = temp_path_for(path)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            with self.lock:
+                self.cache_bytes += len(data) - self.cache_index.pop(path, 0)
+                self.cache_index[path] = len(data)
+                self.evict()
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def evict(self):
+        """
+        Drop least recently used files until the cache fits; the newest entry is always kept.
+        Must be called with the lock held.
+        """
+        while self.cache_bytes > self.cache_max_bytes and len(self.cache_index) > 1:
+            path, size = self.cache_index.popitem(last=False)
+            self.cache_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def read_bytes(self, key):
+        """
+        Read a stored object, through the cache when enabled
+        """
+        if not self.cache_dir:
+            return self.backend.read_bytes(key)
+        path = self.ensure_cached(key)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted between caching and reading
+            return self.backend.read_bytes(key)
+
+    def get_local_path(self, key):
+        """
+        Return a local file path for a key, e.g. for readers that need a path such as cv2.VideoCapture
+        """
+        if not self.cache_dir:
+            local_path = self.backend.get_local_path(key)
+            if local_path is None:
+                raise Exception(f"Storage backend has no local path for {key} and the cache is disabled")
+            return local_path
+        return self.ensure_cached(key)
+
+    def prefetch(self, keys):
+        """
+        Start downloading keys into the cache in the background
+        """
+        if not self.cache_dir:
+            return
+
+        def log_failure(future, key):
+            if future.exception() is not None:
+                logger.warning(f"Prefetch of {key} failed: {future.exception()}")
+
+        for key in keys:
+            with self.lock:
+                if self.cache_path(key) in self.cache_index or key in self.inflight:
+                    continue
+            future = self.prefetch_executor.submit(self.ensure_cached, key)
+            future.add_done_callback(lambda f, key=key: log_failure(f, key))
+
+    def write_bytes(self, key, data):
+        self.backend.write_bytes(key, data)
+
+    def write_async(self, key, data):
+        """
+        Upload in the background; call flush() before relying on the object existing
+        """
+        self.pending_uploads.append(self.upload_executor.submit(self.backend.write_bytes, key, data))
+
+    def flush(self):
+        """
+        Wait for all pending uploads, raising the first upload error
+        """
+        uploads, self.pending_uploads = self.pending_uploads, []
+        errors = [future.exception() for future in uploads if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def delete(self, key):
+        self.backend.delete(key)
+        if self.cache_dir:
+            path = self.cache_path(key)
+            with self.lock:
+                size = self.cache_index.pop(path, None)
+                if size is not None:
+                    self.cache_bytes -= size
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def create_storage():
+    """
+    Build the ImageStore configured by environment variables
+    """
+    backend_name = os.getenv('STORAGE_BACKEND', 'local').lower()
+    if backend_name == 's3':
+        bucket = os.getenv('S3_BUCKET')
+        if not bucket:
+            raise Exception("S3_BUCKET environment variable must be set for the S3 storage backend")
+        backend = S3Storage(bucket, endpoint_url=os.getenv('S3_ENDPOINT_URL'), region=os.getenv('S3_REGION'))
+        default_cache_dir = '/tmp/hairai-image-cache'
+    elif backend_name == 'local':
+        backend = LocalStorage(os.getenv('STORAGE_LOCAL_DIR', '.'))
+        default_cache_dir = None  # Local files are read in place unless a cache dir is given
+    else:
+        raise Exception(f"Unknown STORAGE_BACKEND '{backend_name}', expected 'local' or 's3'")
+
+    cache_dir = os.getenv('STORAGE_CACHE_DIR', default_cache_dir)
+    worker_id = os.getenv('WORKER_ID')
+    if cache_dir and worker_id:
+        # Workers sharing a host each own a subdirectory, so every one stays within its own size limit
+        cache_dir = os.path.join(cache_dir, worker_id.replace(os.sep, '_'))
+    cache_max_bytes = int(os.getenv('STORAGE_CACHE_MAX_MB', '1024')) * 1024 * 1024 if cache_dir else 0
+    logger.info(f"Using {backend_name} image storage")
+    return ImageStore(
+        backend,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        prefetch_workers=int(os.getenv('STORAGE_PREFETCH_WORKERS', '2')),
+        upload_workers=int(os.getenv('STORAGE_UPLOAD_WORKERS', '4'))
+    )
@@ -0,0 +1,153 @@
+"""
+Tests for the ImageStore cache, read-ahead and upload handling, using a LocalStorage backend.
+
+    python test_storage.py
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from storage import ImageStore, LocalStorage, STALE_TEMP_SECONDS
+
+
+class CountingStorage(LocalStorage):
+    """
+    LocalStorage that counts reads, optionally blocks them, and can fail writes
+    """
+    def __init__(self, base_dir):
+        super().__init__(base_dir)
+        self.reads = []
+        self.read_gate = None
+        self.failing_keys = set()
+
+    def read_bytes(self, key):
+        self.reads.append(key)
+        if self.read_gate is not None:
+            self.read_gate.wait(5)
+        return super().read_bytes(key)
+
+    def write_bytes(self, key, data):
+        if key in self.failing_keys:
+            raise IOError(f"Upload of {key} failed")
+        super().write_bytes(key, data)
+
+
+class ImageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.backend = CountingStorage(os.path.join(self.root, 'source'))
+        for name in ('a', 'b', 'c'):
+            self.backend.write_bytes(f"{name}.jpg", name.encode() * 1000)
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.prefetch_executor.shutdown()
+            store.upload_executor.shutdown()
+        shutil.rmtree(self.root)
+
+    def create_store(self, cache_max_bytes=2500):
+        store = ImageStore(self.backend, cache_dir=self.cache_dir, cache_max_bytes=cache_max_bytes)
+        self.stores.append(store)
+        return store
+
+    def cached_files(self):
+        return sorted(name for name in os.listdir(self.cache_dir) if '.tmp-' not in name)
+
+    def test_evicts_least_recently_used_within_limit(self):
+        store = self.create_store()
+        store.read_bytes('a.jpg')
+        store.read_bytes('b.jpg')
+        store.read_bytes('a.jpg')  # a becomes most recently used
+        store.read_bytes('c.jpg')
+
+        self.assertEqual(list(store.cache_index), [store.cache_path('a.jpg'), store.cache_path('c.jpg')])
+        self.assertEqual(store.cache_bytes, 2000)
+        self.assertFalse(os.path.exists(store.cache_path('b.jpg')))
+        self.assertEqual(len(self.cached_files()), 2)
+        self.assertEqual(self.backend.reads, ['a.jpg', 'b.jpg', 'c.jpg'])
+
+    def test_keeps_newest_entry_larger_than_limit(self):
+        store = self.create_store(cache_max_bytes=500)
+        self.assertEqual(store.read_bytes('a.jpg'), b'a' * 1000)
+        self.assertEqual(list(store.cache_index), [store.cache_path('a.jpg')])
+
+    def test_concurrent_requests_share_one_download(self):
+        store = self.create_store()
+        self.backend.read_gate = threading.Event()
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(store.ensure_cached('a.jpg'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        # Let every thread reach ensure_cached before the download completes
+        time.sleep(0.1)
+        self.backend.read_gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.backend.reads, ['a.jpg'])
+        self.assertEqual(paths, [store.cache_path('a.jpg')] * 8)
+        self.assertEqual(store.inflight, {})
+        self.assertEqual(store.cache_bytes, 1000)
+
+    def test_reindexes_cache_on_restart(self):
+        store = self.create_store()
+        for name in ('a', 'b'):
+            store.read_bytes(f"{name}.jpg")
+        # a is older than b on disk
+        os.utime(store.cache_path('a.jpg'), (time.time() - 60, time.time() - 60))
+
+        stale_temp = os.path.join(self.cache_dir, 'x.jpg.tmp-1-1')
+        fresh_temp = os.path.join(self.cache_dir, 'y.jpg.tmp-2-2')
+        for path in (stale_temp, fresh_temp):
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+        os.utime(stale_temp, (time.time() - STALE_TEMP_SECONDS - 60,) * 2)
+
+        restarted = self.create_store()
+        self.assertEqual(list(restarted.cache_index), [store.cache_path('a.jpg'), store.cache_path('b.jpg')])
+        self.assertEqual(restarted.cache_bytes, 2000)
+        self.assertFalse(os.path.exists(stale_temp))
+        self.assertTrue(os.path.exists(fresh_temp))  # May belong to another live process
+
+        self.backend.reads.clear()
+        self.assertEqual(restarted.read_bytes('b.jpg'), b'b' * 1000)
+        self.assertEqual(self.backend.reads, [])
+
+    def test_restart_with_smaller_limit_evicts_oldest(self):
+        store = self.create_store()
+        for age, name in ((120, 'a'), (60, 'b')):
+            store.read_bytes(f"{name}.jpg")
+            os.utime(store.cache_path(f"{name}.jpg"), (time.time() - age,) * 2)
+
+        restarted = self.create_store(cache_max_bytes=1500)
+        self.assertEqual(list(restarted.cache_index), [store.cache_path('b.jpg')])
+        self.assertEqual(restarted.cache_bytes, 1000)
+        self.assertFalse(os.path.exists(store.cache_path('a.jpg')))
+
+    def test_delete_removes_cached_copy(self):
+        store = self.create_store()
+        store.read_bytes('a.jpg')
+        store.delete('a.jpg')
+        self.assertEqual(store.cache_bytes, 0)
+        self.assertEqual(self.cached_files(), [])
+        self.assertFalse(os.path.exists(self.backend.get_local_path('a.jpg')))
+
+    def test_flush_raises_upload_error(self):
+        store = self.create_store()
+        self.backend.failing_keys.add('out/bad.jpg')
+        store.write_async('out/good.jpg', b'good')
+        store.write_async('out/bad.jpg', b'bad')
+
+        with self.assertRaises(IOError):
+            store.flush()
+        self.assertEqual(self.backend.read_bytes('out/good.jpg'), b'good')
+        # Failed uploads are reported once, not again on the next flush
+        store.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
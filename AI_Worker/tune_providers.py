@@ -0,0 +1,199 @@
+"""
+On-host auto-tuner for ONNX Runtime execution providers and session options.
+
+Benchmarks every available CPU execution provider (default CPU, oneDNN, XNNPACK,
+OpenVINO) with a grid of session options on representative images, rejects
+configurations whose outputs differ from the default CPU baseline beyond the
+tolerance, and writes the fastest one as a tuned profile that the worker loads
+at startup (see ORT_TUNED_PROFILE). The profile only applies to the model it
+was tuned on; the worker matches it by file hash.
+
+    python tune_providers.py --images ../uploads --output models/tuned_profile.json
+"""
+import os
+import glob
+import json
+import time
+import argparse
+import platform
+import itertools
+from datetime import datetime, timezone
+import numpy as np
+import cv2
+import onnxruntime as ort
+from worker import AIWorker, create_session_settings, file_sha256, logger
+
+# CPU execution providers worth trying, in order of preference on ties
+CANDIDATE_PROVIDERS = [
+    'CPUExecutionProvider',
+    'DnnlExecutionProvider',
+    'XnnpackExecutionProvider',
+    'OpenVINOExecutionProvider',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ONNX Runtime CPU configurations and write a tuned profile")
+    parser.add_argument('--model', default='models/model_fp32_v2.onnx')
+    parser.add_argument('--images', help="Directory or glob of representative images (default: random inputs)")
+    parser.add_argument('--max-images', type=int, default=8)
+    parser.add_argument('--input-size', default='640x640', help="Model input size as WIDTHxHEIGHT")
+    parser.add_argument('--batch-size', type=int, default=1, help="Images per inference call")
+    parser.add_argument('--warmup', type=int, default=3, help="Untimed runs before measuring")
+    parser.add_argument('--runs', type=int, default=10, help="Timed runs per configuration")
+    parser.add_argument('--threads', default='0',
+                        help="Comma-separated intra-op thread counts to try (0 = ONNX Runtime default)")
+    parser.add_argument('--atol', type=float, default=1e-3)
+    parser.add_argument('--rtol', type=float, default=1e-3)
+    parser.add_argument('--output', default='models/tuned_profile.json')
+    return parser.parse_args()
+
+
+def load_batches(args):
+    """
+    Preprocess representative images exactly as the worker does and group them into batches
+    """
+    width, height = (int(v) for v in args.input_size.lower().split('x'))
+    input_shape = (height, width)
+
+    paths = []
+    if args.images:
+        pattern = os.path.join(args.images, '*') if os.path.isdir(args.images) else args.images
+        paths = sorted(p for p in glob.glob(pattern) if p.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')))
+    paths = paths[:args.max_images]
+
+    # Instance without __init__: only the stateless preprocessing methods are used
+    preprocessor = AIWorker.__new__(AIWorker)
+    if paths:
+        tensors = []
+        for path in paths:
+            image = cv2.imread(path)
+            if image is None:
+                logger.warning(f"Could not read image at {path}, skipping")
+                continue
+            tensors.append(preprocessor.preprocess_image(image, input_shape))
+    else:
+        logger.warning("No representative images given, benchmarking with random inputs")
+        rng = np.random.default_rng(0)
+        tensors = [rng.random((3, height, width), dtype=np.float32) for _ in range(args.max_images)]
+
+    if not tensors:
+        raise Exception("No usable images to benchmark with")
+    logger.info(f"Benchmarking with {len(tensors)} images")
+    return [np.stack(tensors[i:i + args.batch_size]) for i in range(0, len(tensors), args.batch_size)]
+
+
+def candidate_profiles(args):
+    """
+    Yield every provider and session option combination to benchmark
+    """
+    available = ort.get_available_providers()
+    providers = [p for p in CANDIDATE_PROVIDERS if p in available]
+    logger.info(f"Available CPU execution providers: {providers}")
+
+    grid = itertools.product(
+        providers,
+        ['ORT_ENABLE_BASIC', 'ORT_ENABLE_EXTENDED', 'ORT_ENABLE_ALL'],
+        ['ORT_SEQUENTIAL', 'ORT_PARALLEL'],
+        [int(t) for t in args.threads.split(',')],
+        [True, False],  # allow_spinning
+        [True, False],  # enable_cpu_mem_arena
+    )
+    for provider, opt_level, execution_mode, threads, spinning, arena in grid:
+        yield {
+            "providers": [provider] if provider == 'CPUExecutionProvider' else [provider, 'CPUExecutionProvider'],
+            "session_options": {
+                "graph_optimization_level": opt_level,
+                "execution_mode": execution_mode,
+                "intra_op_num_threads": threads,
+                "inter_op_num_threads": 0,
+                "allow_spinning": spinning,
+                "enable_cpu_mem_arena": arena
+            }
+        }
+
+
+def benchmark(session, batches, args):
+    """
+    Return (median latency per image in ms, outputs of the first pass over the batches)
+    """
+    input_name = session.get_inputs()[0].name
+    outputs = [session.run(None, {input_name: batch}) for batch in batches]
+    for _ in range(args.warmup - 1):
+        for batch in batches:
+            session.run(None, {input_name: batch})
+
+    timings = []
+    for _ in range(args.runs):
+        start_time = time.perf_counter()
+        for batch in batches:
+            session.run(None, {input_name: batch})
+        timings.append((time.perf_counter() - start_time) * 1000 / sum(len(b) for b in batches))
+    return float(np.median(timings)), outputs
+
+
+def outputs_match(outputs, baseline, args):
+    """
+    Check every output tensor against the baseline within tolerance
+    """
+    for batch_outputs, batch_baseline in zip(outputs, baseline):
+        for output, expected in zip(batch_outputs, batch_baseline):
+            if output.shape != expected.shape or not np.allclose(output, expected, atol=args.atol, rtol=args.rtol):
+                return False
+    return True
+
+
+def tune(args):
+    batches = load_batches(args)
+
+    # Baseline: what the worker used before tuning
+    baseline_session = ort.InferenceSession(args.model, providers=['CPUExecutionProvider'])
+    baseline_ms, baseline_outputs = benchmark(baseline_session, batches, args)
+    del baseline_session
+    logger.info(f"Baseline CPUExecutionProvider with default options: {baseline_ms:.1f} ms/image")
+
+    best_profile, best_ms = None, baseline_ms
+    for profile in candidate_profiles(args):
+        label = f"{profile['providers'][0]} {profile['session_options']}"
+        try:
+            providers, options = create_session_settings(profile)
+            session = ort.InferenceSession(args.model, sess_options=options, providers=providers)
+            latency_ms, outputs = benchmark(session, batches, args)
+            del session
+        except Exception as e:
+            logger.warning(f"{label}: failed ({str(e)})")
+            continue
+
+        if not outputs_match(outputs, baseline_outputs, args):
+            logger.warning(f"{label}: {latency_ms:.1f} ms/image, outputs differ from baseline, rejected")
+            continue
+        logger.info(f"{label}: {latency_ms:.1f} ms/image")
+        if latency_ms < best_ms:
+            best_profile, best_ms = profile, latency_ms
+
+    if best_profile is None:
+        logger.info("No configuration beat the baseline, writing the default CPU profile")
+        best_profile = {"providers": ['CPUExecutionProvider'], "session_options": {}}
+
+    best_profile.update({
+        "model": args.model,
+        "model_sha256": file_sha256(args.model),
+        "latency_ms_per_image": round(best_ms, 2),
+        "baseline_latency_ms_per_image": round(baseline_ms, 2),
+        "batch_size": args.batch_size,
+        "host": {
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "onnxruntime_version": ort.__version__
+        },
+        "tuned_at": datetime.now(timezone.utc).isoformat()
+    })
+    with open(args.output, 'w') as f:
+        json.dump(best_profile, f, indent=2)
+    logger.info(f"Tuned profile written to {args.output}: {best_ms:.1f} ms/image "
+                f"({baseline_ms / best_ms:.2f}x baseline)")
+
+
+if __name__ == "__main__":
+    tune(parse_args())
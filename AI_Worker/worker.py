@@ -2,18 +2,64 @@ import os
 import pika
 import json
 import psycopg2
+import psycopg2.extras
 import logging
 import time
+import socket
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 import onnxruntime as ort
 import cv2
 from sklearn.cluster import DBSCAN
+from collections import deque
+from storage import create_storage
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def create_session_settings(profile):
+    """
+    Build (providers, SessionOptions) from a tuned profile dictionary.
+    Providers not available on this host are dropped; CPUExecutionProvider is always the fallback.
+    """
+    available = ort.get_available_providers()
+    providers = [p for p in profile.get("providers", []) if p in available]
+    dropped = [p for p in profile.get("providers", []) if p not in available]
+    if dropped:
+        logger.warning(f"Execution providers not available on this host, skipping: {dropped}")
+    if 'CPUExecutionProvider' not in providers:
+        providers.append('CPUExecutionProvider')
+    
+    settings = profile.get("session_options", {})
+    options = ort.SessionOptions()
+    if "graph_optimization_level" in settings:
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, settings["graph_optimization_level"])
+    if "execution_mode" in settings:
+        options.execution_mode = getattr(ort.ExecutionMode, settings["execution_mode"])
+    if "intra_op_num_threads" in settings:
+        options.intra_op_num_threads = settings["intra_op_num_threads"]
+    if "inter_op_num_threads" in settings:
+        options.inter_op_num_threads = settings["inter_op_num_threads"]
+    if "enable_cpu_mem_arena" in settings:
+        options.enable_cpu_mem_arena = settings["enable_cpu_mem_arena"]
+    if "allow_spinning" in settings:
+        options.add_session_config_entry('session.intra_op.allow_spinning', '1' if settings["allow_spinning"] else '0')
+    return providers, options
+
+def file_sha256(path):
+    """
+    Hash a model file so a tuned profile can be matched to the exact model it was validated on
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 class AIWorker:
     def __init__(self):
         # Get configuration from environment variables
@@ -26,10 +72,72 @@ class AIWorker:
         self.distance_threshold = 100
         self.pixels_per_mm = 600
         
+        # Job leasing - identifies this worker and bounds how long a claimed job is held
+        self.worker_id = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+        # Long video and session jobs renew the lease after every inference batch (see renew_leases)
+        self.lease_seconds = int(os.getenv('JOB_LEASE_SECONDS', '600'))
+        # Messages for jobs leased by another live worker are retried after this delay
+        self.lease_retry_seconds = int(os.getenv('LEASE_RETRY_SECONDS', '30'))
+        
+        # Progressive analysis - a fast preview pass is written before the full-accuracy pass
+        self.progressive_mode = os.getenv('PROGRESSIVE_ANALYSIS', 'false').lower() == 'true'
+        self.preview_input_shape = (320, 320)  # Used when the preview runs on the full model
+        self.refinement_shed_queue_depth = int(os.getenv('REFINEMENT_SHED_QUEUE_DEPTH', '50'))
+        
+        # Video / burst-capture analysis - frames are filtered before inference
+        self.video_extensions = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+        self.video_frame_stride = int(os.getenv('VIDEO_FRAME_STRIDE', '1'))  # Read every Nth frame
+        if self.video_frame_stride < 1:
+            logger.warning(f"VIDEO_FRAME_STRIDE must be at least 1, got {self.video_frame_stride}; using 1")
+            self.video_frame_stride = 1
+        self.video_min_sharpness = float(os.getenv('VIDEO_MIN_SHARPNESS', '100'))  # Variance of Laplacian
+        self.video_dedup_distance = int(os.getenv('VIDEO_DEDUP_DISTANCE', '6'))  # Hamming distance on 64-bit dHash
+        self.video_batch_size = int(os.getenv('VIDEO_BATCH_SIZE', '8'))
+        
+        # Session analysis - images are decoded and inferred in chunks to bound memory
+        self.session_batch_size = max(1, int(os.getenv('SESSION_BATCH_SIZE', '8')))
+        
+        # Versioned model registry - the worker serves the manifest named in <registry>/ACTIVE
+        self.model_registry_dir = os.getenv('MODEL_REGISTRY_DIR', 'models/registry')
+        self.model_registry_poll_seconds = float(os.getenv('MODEL_REGISTRY_POLL_SECONDS', '10'))
+        self.default_model_manifest = {
+            "version": os.path.splitext(os.path.basename(self.model_path))[0],
+            "path": os.path.abspath(self.model_path),
+            "input_size": [640, 640],  # Standard YOLOv8 input size
+            # Class names based on the old script
+            "class_map": {"0": "single", "1": "double", "2": "triple+", "3": "abnormal", "4": "undersize"},
+            "thresholds": {"confidence": 0.15, "nms": 0.45}
+        }
+        preview_model_path = 'models/model_quantized_v2.onnx'
+        if os.path.exists(preview_model_path):
+            self.default_model_manifest["preview_path"] = os.path.abspath(preview_model_path)
+        
+        # Tuned execution provider / session options profile written by tune_providers.py
+        self.tuned_profile_path = os.getenv('ORT_TUNED_PROFILE', 'models/tuned_profile.json')
+        self.tuned_profile = {}
+        if os.path.exists(self.tuned_profile_path):
+            with open(self.tuned_profile_path) as f:
+                self.tuned_profile = json.load(f)
+            logger.info(f"Using tuned profile {self.tuned_profile_path}: providers {self.tuned_profile.get('providers')}, "
+                        f"session options {self.tuned_profile.get('session_options')}")
+        
+        # Image storage - reads ImageStorageKey and writes annotated images (local FS or S3)
+        self.storage = create_storage()
+        # Messages RabbitMQ may deliver ahead of the current job; their images are read ahead.
+        # Read-ahead needs the disk cache, so without one no extra message is held back from other workers.
+        self.prefetch_messages = int(os.getenv('PREFETCH_MESSAGES', '1' if self.storage.cache_dir else '0'))
+        self.pending_messages = deque()
+        
         # Initialize ONNX model
-        logger.info(f"Loading ONNX model from {self.model_path}")
-        self.model = ort.InferenceSession(self.model_path, providers=['CPUExecutionProvider'])
-        logger.info("Model loaded successfully")
+        self.model_lock = threading.Lock()
+        self.pending_model = None
+        self.registry_signature = self.get_registry_signature()
+        manifest = self.read_active_manifest() or self.default_model_manifest
+        self.install_model(self.load_model(manifest))
+        
+        # Watch the registry for new model versions
+        if os.path.isdir(self.model_registry_dir):
+            threading.Thread(target=self.watch_model_registry, daemon=True).start()
         
         # Check if environment variables are set
         if not self.rabbitmq_connection_string:
@@ -54,6 +162,11 @@ class AIWorker:
                 )
                 self.channel = self.connection.channel()
                 self.channel.queue_declare(queue='analysis_jobs', durable=True)
+                # Delayed retries: messages expire from this queue back into analysis_jobs
+                self.channel.queue_declare(queue='analysis_jobs_retry', durable=True, arguments={
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': 'analysis_jobs'
+                })
                 logger.info("Connected to RabbitMQ")
                 break
             except Exception as e:
@@ -84,6 +197,148 @@ class AIWorker:
                     logger.error("Failed to connect to database after all retries")
                     raise
 
+    def get_registry_signature(self):
+        """
+        Return (active version, manifest mtime) so registry changes can be detected cheaply
+        """
+        active_path = os.path.join(self.model_registry_dir, 'ACTIVE')
+        try:
+            with open(active_path) as f:
+                version = f.read().strip()
+            manifest_path = os.path.join(self.model_registry_dir, f"{version}.json")
+            return (version, os.path.getmtime(manifest_path))
+        except OSError:
+            return None
+
+    def read_active_manifest(self):
+        """
+        Read the manifest of the active model version, or None if there is no registry
+        """
+        signature = self.get_registry_signature()
+        if signature is None:
+            return None
+        manifest_path = os.path.join(self.model_registry_dir, f"{signature[0]}.json")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest.setdefault("version", signature[0])
+        # Model paths in manifests are relative to the registry directory
+        manifest["path"] = os.path.join(self.model_registry_dir, manifest["path"])
+        if "preview_path" in manifest:
+            manifest["preview_path"] = os.path.join(self.model_registry_dir, manifest["preview_path"])
+        return manifest
+
+    def load_model(self, manifest):
+        """
+        Build and warm an InferenceSession for a model manifest, plus its preview model in progressive mode
+        """
+        defaults = self.default_model_manifest
+        thresholds = {**defaults["thresholds"], **manifest.get("thresholds", {})}
+        input_shape = tuple(manifest.get("input_size", defaults["input_size"]))
+        
+        logger.info(f"Loading ONNX model {manifest['version']} from {manifest['path']}")
+        session = self.create_inference_session(manifest["path"])
+        
+        # Warm up so the first job on this model does not pay for lazy initialization
+        model_input = session.get_inputs()[0]
+        session.run(None, {model_input.name: np.zeros((1, 3) + input_shape, dtype=np.float32)})
+        logger.info(f"Model {manifest['version']} loaded successfully")
+        
+        # The preview model ships with the manifest so it shares its class map and thresholds
+        preview_session, preview_version = None, manifest["version"]
+        if self.progressive_mode and manifest.get("preview_path"):
+            logger.info(f"Loading preview ONNX model from {manifest['preview_path']}")
+            preview_session = self.create_inference_session(manifest["preview_path"])
+            preview_input = preview_session.get_inputs()[0]
+            preview_shape = self.get_model_input_shape(preview_session)
+            preview_session.run(None, {preview_input.name: np.zeros((1, 3) + preview_shape, dtype=np.float32)})
+            preview_version = manifest.get("preview_version",
+                                           os.path.splitext(os.path.basename(manifest["preview_path"]))[0])
+            logger.info(f"Preview model {preview_version} loaded successfully")
+        
+        return {
+            "version": manifest["version"],
+            "session": session,
+            "preview_session": preview_session,
+            "preview_version": preview_version,
+            "input_shape": input_shape,
+            "class_names": {int(k): v for k, v in manifest.get("class_map", defaults["class_map"]).items()},
+            "conf_threshold": thresholds["confidence"],
+            "nms_threshold": thresholds["nms"]
+        }
+
+    def create_inference_session(self, model_path):
+        """
+        Create an InferenceSession with the tuned providers and session options if the profile was
+        tuned on this model, otherwise with default CPU settings
+        """
+        profile = self.tuned_profile if self.tuned_profile_matches(model_path) else {}
+        providers, options = create_session_settings(profile)
+        return ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+    def tuned_profile_matches(self, model_path):
+        """
+        The tuned profile is only validated against the outputs of the model it was tuned on
+        """
+        if not self.tuned_profile:
+            return False
+        if "model_sha256" in self.tuned_profile:
+            matches = file_sha256(model_path) == self.tuned_profile["model_sha256"]
+        else:
+            matches = os.path.realpath(model_path) == os.path.realpath(self.tuned_profile.get("model", ""))
+        if not matches:
+            logger.info(f"Tuned profile was not tuned on {model_path}, using default CPU settings for it")
+        return matches
+
+    def install_model(self, bundle):
+        """
+        Make a loaded model the one used for inference
+        """
+        self.model = bundle["session"]
+        self.model_version = bundle["version"]
+        self.model_input_shape = bundle["input_shape"]
+        self.class_names = bundle["class_names"]
+        self.conf_threshold = bundle["conf_threshold"]
+        self.nms_threshold = bundle["nms_threshold"]
+        # Without a preview model the preview runs on the main model at a lower resolution
+        self.preview_model = bundle["preview_session"]
+        self.preview_version = bundle["preview_version"]
+        if self.progressive_mode and not self.preview_available():
+            logger.warning(f"Progressive analysis disabled for {self.model_version}: no preview model and the main "
+                           "model has a fixed input size, so a preview pass would cost as much as the full pass")
+
+    def watch_model_registry(self):
+        """
+        Background thread: build and warm new model versions as they appear in the registry.
+        The swap itself happens on the consumer thread between messages.
+        """
+        while True:
+            time.sleep(self.model_registry_poll_seconds)
+            signature = self.get_registry_signature()
+            if signature is None or signature == self.registry_signature:
+                continue
+            # Remember the signature even on failure so a bad manifest is not rebuilt every poll
+            self.registry_signature = signature
+            try:
+                bundle = self.load_model(self.read_active_manifest())
+            except Exception as e:
+                logger.error(f"Failed to load model version {signature[0]}: {str(e)}")
+                continue
+            with self.model_lock:
+                self.pending_model = bundle
+            logger.info(f"Model {bundle['version']} is ready and will be used from the next message")
+
+    def apply_pending_model(self):
+        """
+        Swap in a newly loaded model. Called between messages, so no job is using the old session;
+        it is released once the last reference to it is dropped here.
+        """
+        with self.model_lock:
+            bundle, self.pending_model = self.pending_model, None
+        if bundle is not None:
+            previous_version = self.model_version
+            self.install_model(bundle)
+            logger.info(f"Swapped model {previous_version} -> {self.model_version}")
+
     def measure_thickness_from_bbox(self, coords):
         """
         Calculates thickness based on the minor axis of the bounding box.
@@ -97,7 +352,11 @@ class AIWorker:
     def draw_final_label(self, image, label, coords):
         """
         Draws the final interpreted bounding box and label.
+        Does nothing when no image is given (metrics-only analysis).
         """
+        if image is None:
+            return
+        
         x1, y1, x2, y2 = coords
         
         color_map = {
@@ -138,35 +397,59 @@ class AIWorker:
                 # No need to prepend anything, the path should be correct
                 pass
             
+            # Videos and burst captures are streamed frame by frame instead
+            if image_path.lower().endswith(self.video_extensions):
+                return self.process_video(job_id, self.storage.get_local_path(image_path))
+            
             logger.info(f"Loading image from {image_path}")
-            original_image = cv2.imread(image_path)
+            original_image = self.load_image(image_path)
             if original_image is None:
                 raise Exception(f"Could not read image at {image_path}")
             
             analysis_image = original_image.copy()
             logger.info(f"Image loaded successfully. Shape: {original_image.shape}")
             
-            # 3. Run the AI model on the image
+            # 3. In progressive mode, publish a fast preview result before the full pass
+            if self.progressive_mode and self.preview_available():
+                detections = self.run_preview_pass(job_id, original_image)
+                if self.should_shed_refinement():
+                    logger.info(f"Queue is overloaded, skipping refinement pass for job {job_id}")
+                    results = self.analyze_detections(detections, analysis_image, original_image)
+                    annotated_image_path = self.save_annotated_image(analysis_image, job_id)
+                    self.storage.flush()
+                    return {
+                        "metrics": results["metrics"],
+                        "follicular_breakdown": results["follicular_breakdown"],
+                        "other_detections": results["other_detections"],
+                        "annotated_image_path": annotated_image_path,
+                        "analysis_stage": "preview",
+                        "model_version": self.preview_version
+                    }
+            
+            # 4. Run the AI model on the image
             logger.info("Running model inference")
             detections = self.run_inference(original_image)
             logger.info(f"Found {len(detections)} detections")
             
-            # 4. Process detections and calculate metrics
+            # 5. Process detections and calculate metrics
             logger.info("Analyzing detections")
             results = self.analyze_detections(detections, analysis_image, original_image)
             logger.info("Analysis completed")
             
-            # 5. Save the annotated image
+            # 6. Save the annotated image
             annotated_image_path = self.save_annotated_image(analysis_image, job_id)
+            self.storage.flush()
             logger.info(f"Annotated image saved to {annotated_image_path}")
             
-            # 6. Prepare results for database update
+            # 7. Prepare results for database update
             final_results = {
                 "metrics": results["metrics"],
                 "follicular_breakdown": results["follicular_breakdown"],
                 "other_detections": results["other_detections"],
                 "annotated_image_path": annotated_image_path
             }
+            if self.progressive_mode and self.preview_available():
+                final_results["analysis_stage"] = "refined"
             
             logger.info(f"Job {job_id} processed successfully")
             return final_results
@@ -175,6 +458,337 @@ class AIWorker:
             logger.error(f"Error processing job {job_id}: {str(e)}")
             raise
 
+    def preview_available(self):
+        """
+        A preview is only cheaper than the full pass with a separate preview model,
+        or when the main model accepts the lower preview resolution (dynamic input size)
+        """
+        return self.preview_model is not None or self.get_model_input_shape(self.model, None) is None
+
+    def run_preview_pass(self, job_id, image):
+        """
+        Run the cheap preview pass and write its metrics as a provisional result.
+        Returns the preview detections so they can be reused if refinement is skipped.
+        """
+        start_time = time.time()
+        if self.preview_model is not None:
+            model = self.preview_model
+            input_shape = self.get_model_input_shape(model)
+        else:
+            model = self.model
+            input_shape = self.get_model_input_shape(model, self.preview_input_shape)
+        
+        detections = self.run_batch_inference([image], model=model, input_shape=input_shape)[0]
+        
+        # Skip drawing for the preview, only the metrics are published
+        results = self.analyze_detections(detections, None, image)
+        preview_results = {
+            "metrics": results["metrics"],
+            "follicular_breakdown": results["follicular_breakdown"],
+            "other_detections": results["other_detections"],
+            "analysis_stage": "preview",
+            "model_version": self.preview_version
+        }
+        self.update_job_preview(job_id, preview_results)
+        logger.info(f"Preview for job {job_id} written in {(time.time() - start_time) * 1000:.0f} ms "
+                    f"({len(detections)} detections)")
+        return detections
+
+    def should_shed_refinement(self):
+        """
+        Check whether the queue is backed up enough to skip the refinement pass
+        """
+        if not getattr(self, 'channel', None):
+            return False
+        try:
+            queue = self.channel.queue_declare(queue='analysis_jobs', durable=True, passive=True)
+            return queue.method.message_count >= self.refinement_shed_queue_depth
+        except Exception as e:
+            logger.warning(f"Could not read queue depth: {str(e)}")
+            return False
+
+    def process_video(self, job_id, video_path):
+        """
+        Analyze a video or burst capture as a stream of frames.
+        Blurry and near-duplicate frames are skipped before inference, kept frames are
+        batched through the model, and only the best frame and running statistics are
+        held in memory.
+        """
+        logger.info(f"Streaming video from {video_path}")
+        metric_keys = ("follicular_unit_density", "average_hairs_per_fu", "average_hair_thickness_microns")
+        stats = {key: {"sum": 0.0, "sum_sq": 0.0, "min": None, "max": None} for key in metric_keys}
+        counts = {"frames_read": 0, "frames_kept": 0, "skipped_blurry": 0, "skipped_duplicate": 0}
+        best = {"sharpness": -1.0, "frame": None, "detections": None, "frame_index": None}
+        
+        def analyze_batch(batch):
+            batch_detections = self.run_batch_inference([frame for _, frame, _ in batch])
+            for (frame_index, frame, sharpness), detections in zip(batch, batch_detections):
+                # Metrics only, annotations are drawn for the best frame at the end
+                metrics = self.analyze_detections(detections, None, frame)["metrics"]
+                for key in metric_keys:
+                    value = metrics[key]
+                    stats[key]["sum"] += value
+                    stats[key]["sum_sq"] += value * value
+                    stats[key]["min"] = value if stats[key]["min"] is None else min(stats[key]["min"], value)
+                    stats[key]["max"] = value if stats[key]["max"] is None else max(stats[key]["max"], value)
+                if sharpness > best["sharpness"]:
+                    best.update(sharpness=sharpness, frame=frame, detections=detections, frame_index=frame_index)
+        
+        batch = []
+        last_kept_hash = None
+        # Sharpest blurry frame, analyzed instead of failing the job if no frame passes the threshold
+        fallback = None
+        for frame_index, frame in self.iter_video_frames(video_path):
+            counts["frames_read"] += 1
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            
+            sharpness = self.frame_sharpness(gray)
+            if sharpness < self.video_min_sharpness:
+                counts["skipped_blurry"] += 1
+                if counts["frames_kept"] == 0 and (fallback is None or sharpness > fallback[2]):
+                    fallback = (frame_index, frame, sharpness)
+                continue
+            
+            frame_hash = self.frame_hash(gray)
+            if last_kept_hash is not None and bin(frame_hash ^ last_kept_hash).count('1') <= self.video_dedup_distance:
+                counts["skipped_duplicate"] += 1
+                continue
+            
+            last_kept_hash = frame_hash
+            counts["frames_kept"] += 1
+            fallback = None
+            batch.append((frame_index, frame, sharpness))
+            if len(batch) >= self.video_batch_size:
+                analyze_batch(batch)
+                batch = []
+                self.renew_leases([job_id])
+        
+        if batch:
+            analyze_batch(batch)
+        
+        used_fallback = counts["frames_kept"] == 0 and fallback is not None
+        if used_fallback:
+            logger.warning(f"No frame reached VIDEO_MIN_SHARPNESS {self.video_min_sharpness}, "
+                           f"analyzing the sharpest frame {fallback[0]} (sharpness {fallback[2]:.1f})")
+            analyze_batch([fallback])
+            counts["frames_kept"] = 1
+            counts["skipped_blurry"] -= 1
+        
+        logger.info(f"Video frames read: {counts['frames_read']}, kept: {counts['frames_kept']}, "
+                    f"blurry: {counts['skipped_blurry']}, duplicate: {counts['skipped_duplicate']}")
+        if best["frame"] is None:
+            raise Exception(f"No usable frames in video at {video_path}")
+        
+        # Full analysis with annotations for the best frame only
+        analysis_image = best["frame"].copy()
+        results = self.analyze_detections(best["detections"], analysis_image, best["frame"])
+        annotated_image_path = self.save_annotated_image(analysis_image, job_id)
+        self.storage.flush()
+        logger.info(f"Annotated best frame {best['frame_index']} saved to {annotated_image_path}")
+        
+        kept = counts["frames_kept"]
+        aggregate = {}
+        for key in metric_keys:
+            mean = stats[key]["sum"] / kept
+            variance = max(stats[key]["sum_sq"] / kept - mean * mean, 0.0)
+            aggregate[key] = {
+                "mean": round(mean, 2),
+                "std": round(float(np.sqrt(variance)), 2),
+                "min": round(stats[key]["min"], 2),
+                "max": round(stats[key]["max"], 2)
+            }
+        
+        return {
+            "metrics": results["metrics"],
+            "follicular_breakdown": results["follicular_breakdown"],
+            "other_detections": results["other_detections"],
+            "annotated_image_path": annotated_image_path,
+            "video_summary": {
+                **counts,
+                "best_frame_index": best["frame_index"],
+                "best_frame_sharpness": round(best["sharpness"], 2),
+                "below_min_sharpness": used_fallback,
+                "frame_metrics": aggregate
+            }
+        }
+
+    def iter_video_frames(self, video_path):
+        """
+        Yield (frame_index, frame) from a video file one frame at a time
+        """
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise Exception(f"Could not open video at {video_path}")
+        try:
+            frame_index = 0
+            while True:
+                # grab() still decodes every frame; only retrieve()'s conversion is skipped between strides
+                if not capture.grab():
+                    break
+                if frame_index % self.video_frame_stride == 0:
+                    ok, frame = capture.retrieve()
+                    if not ok:
+                        break
+                    yield frame_index, frame
+                frame_index += 1
+        finally:
+            capture.release()
+
+    def frame_sharpness(self, gray):
+        """
+        Score focus as the variance of the Laplacian on a downscaled frame
+        """
+        small = cv2.resize(gray, (320, int(320 * gray.shape[0] / gray.shape[1])), interpolation=cv2.INTER_AREA)
+        return float(cv2.Laplacian(small, cv2.CV_64F).var())
+
+    def frame_hash(self, gray):
+        """
+        Compute a 64-bit difference hash (dHash) for near-duplicate detection
+        """
+        small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return int(np.packbits(bits).view('>u8')[0])
+
+    def process_session(self, session_id, job_ids):
+        """
+        Process several images from one analysis session together:
+        decode in parallel and run batched inference in chunks of session_batch_size,
+        then aggregate the regions
+        """
+        logger.info(f"Processing session {session_id} with {len(job_ids)} images")
+        
+        # 1. Retrieve details for all jobs in one query
+        jobs = self.get_session_job_details(job_ids)
+        missing = [job_id for job_id in job_ids if job_id not in jobs]
+        if missing:
+            logger.warning(f"Jobs not found for session {session_id}: {missing}")
+        
+        # 2. Read and decode the images in parallel (cv2 releases the GIL while decoding)
+        loaded_job_ids = [job_id for job_id in job_ids if job_id in jobs]
+        failures = {job_id: f"Job {job_id} not found" for job_id in missing}
+        
+        def load_session_image(job_id):
+            try:
+                return self.load_image(jobs[job_id]['image_path'])
+            except Exception as e:
+                logger.error(f"Error reading image for job {job_id}: {str(e)}")
+                return None
+        
+        # Only one chunk of decoded images is held in memory at a time
+        results = {}
+        max_workers = max(1, min(len(loaded_job_ids), self.session_batch_size, os.cpu_count() or 1))
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for start in range(0, len(loaded_job_ids), self.session_batch_size):
+                    chunk_job_ids = loaded_job_ids[start:start + self.session_batch_size]
+                    images = list(executor.map(load_session_image, chunk_job_ids))
+                    
+                    decoded = []
+                    for job_id, image in zip(chunk_job_ids, images):
+                        if image is None:
+                            failures[job_id] = f"Could not read image at {jobs[job_id]['image_path']}"
+                            logger.error(failures[job_id])
+                        else:
+                            decoded.append((job_id, image))
+                    if not decoded:
+                        continue
+                    
+                    # 3. Run the AI model on the chunk as one batch
+                    logger.info(f"Running batched model inference on {len(decoded)} images")
+                    batch_detections = self.run_batch_inference([image for _, image in decoded])
+                    # Results are written together at the end, so every job in the session stays leased
+                    self.renew_leases(loaded_job_ids)
+                    
+                    # 4. Analyze each region and save its annotated image (uploads run in parallel)
+                    for (job_id, original_image), detections in zip(decoded, batch_detections):
+                        analysis_image = original_image.copy()
+                        region_results = self.analyze_detections(detections, analysis_image, original_image)
+                        results[job_id] = {
+                            "location_tag": jobs[job_id]['location_tag'],
+                            "metrics": region_results["metrics"],
+                            "follicular_breakdown": region_results["follicular_breakdown"],
+                            "other_detections": region_results["other_detections"],
+                            "annotated_image_path": self.save_annotated_image(analysis_image, job_id)
+                        }
+        finally:
+            self.storage.flush()
+        
+        if not results:
+            return {}, failures
+        
+        # 5. Attach the session-wide aggregate to every region result
+        aggregate = self.aggregate_session_results(list(results.values()))
+        for job_id in results:
+            results[job_id]["session_aggregate"] = aggregate
+        
+        logger.info(f"Session {session_id} processed: {len(results)} succeeded, {len(failures)} failed")
+        return results, failures
+
+    def aggregate_session_results(self, region_results):
+        """
+        Combine per-region results into session-level metrics,
+        including the donor/recipient follicular unit density ratio
+        """
+        # Location tags treated as donor area, all other regions are recipient areas
+        donor_keywords = ('occipital', 'donor')
+        
+        donor_densities = []
+        recipient_densities = []
+        for region in region_results:
+            density = region["metrics"]["follicular_unit_density"]
+            location_tag = (region.get("location_tag") or '').lower()
+            if any(keyword in location_tag for keyword in donor_keywords):
+                donor_densities.append(density)
+            else:
+                recipient_densities.append(density)
+        
+        donor_density = np.mean(donor_densities) if donor_densities else 0
+        recipient_density = np.mean(recipient_densities) if recipient_densities else 0
+        
+        def mean_metric(key):
+            return round(float(np.mean([region["metrics"][key] for region in region_results])), 2)
+        
+        return {
+            "region_count": len(region_results),
+            "regions": [region.get("location_tag") for region in region_results],
+            "average_follicular_unit_density": mean_metric("follicular_unit_density"),
+            "average_hairs_per_fu": mean_metric("average_hairs_per_fu"),
+            "average_hair_thickness_microns": mean_metric("average_hair_thickness_microns"),
+            "donor_follicular_unit_density": round(float(donor_density), 2),
+            "recipient_follicular_unit_density": round(float(recipient_density), 2),
+            "donor_recipient_density_ratio": round(float(donor_density / recipient_density), 2) if recipient_density > 0 else None
+        }
+
+    def get_session_job_details(self, job_ids):
+        """
+        Retrieve details for several jobs in one query, keyed by job ID
+        """
+        try:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                SELECT aj."Id", aj."ImageStorageKey", aj."LocationTag", aj."CalibrationProfileId", cp."CalibrationData"
+                FROM "AnalysisJobs" aj
+                LEFT JOIN "CalibrationProfiles" cp ON aj."CalibrationProfileId" = cp."Id"
+                WHERE aj."Id" = ANY(%s::uuid[])
+            """, ([str(job_id) for job_id in job_ids],))
+            
+            rows = cursor.fetchall()
+            # End the read transaction so later writes get a fresh NOW()
+            self.db_connection.commit()
+            return {
+                str(row[0]): {
+                    "image_path": row[1],  # ImageStorageKey
+                    "location_tag": row[2],
+                    "calibration_profile_id": row[3],
+                    "calibration_data": row[4]
+                }
+                for row in rows
+            }
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.error(f"Error retrieving session job details: {str(e)}")
+            return {}
+
     def get_job_details(self, job_id):
         """
         Retrieve job details from the database
@@ -189,6 +803,8 @@ class AIWorker:
             """, (str(job_id),))
             
             row = cursor.fetchone()
+            # End the read transaction so later writes get a fresh NOW()
+            self.db_connection.commit()
             if row:
                 return {
                     "image_path": row[0],  # ImageStorageKey
@@ -197,9 +813,120 @@ class AIWorker:
                 }
             return None
         except Exception as e:
+            self.db_connection.rollback()
             logger.error(f"Error retrieving job details: {str(e)}")
             return None
 
+    def claim_job(self, job_id):
+        """
+        Atomically lease a job for this worker.
+        Pending jobs and Processing jobs whose lease has expired can be claimed.
+        Returns True if this worker now holds the lease, False otherwise.
+        """
+        return str(job_id) in self.claim_jobs([job_id])
+
+    def claim_jobs(self, job_ids):
+        """
+        Atomically lease several jobs for this worker in one statement.
+        Returns the set of job IDs this worker now holds the lease on.
+        """
+        try:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                UPDATE "AnalysisJobs"
+                SET "Status" = %s,
+                    "StartedAt" = NOW(),
+                    "LeasedBy" = %s,
+                    "LeaseExpiresAt" = NOW() + %s * INTERVAL '1 second'
+                WHERE "Id" = ANY(%s::uuid[])
+                  AND ("Status" IN (%s)
+                       OR ("Status" = %s AND ("LeaseExpiresAt" IS NULL OR "LeaseExpiresAt" < NOW())))
+                RETURNING "Id"
+            """, (1, self.worker_id, self.lease_seconds, [str(job_id) for job_id in job_ids], 0, 1))  # 0 = Pending, 1 = Processing
+            
+            claimed = {str(row[0]) for row in cursor.fetchall()}
+            self.db_connection.commit()
+            if claimed:
+                logger.info(f"Claimed {len(claimed)} of {len(job_ids)} jobs "
+                            f"(lease held by {self.worker_id} for {self.lease_seconds}s)")
+            return claimed
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.error(f"Error claiming jobs {job_ids}: {str(e)}")
+            raise
+
+    def renew_leases(self, job_ids):
+        """
+        Extend the leases this worker holds, so jobs that outlive JOB_LEASE_SECONDS are not reclaimed
+        by another worker while still in progress
+        """
+        try:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                UPDATE "AnalysisJobs"
+                SET "LeaseExpiresAt" = NOW() + %s * INTERVAL '1 second'
+                WHERE "Id" = ANY(%s::uuid[]) AND "Status" = %s AND "LeasedBy" = %s
+            """, (self.lease_seconds, [str(job_id) for job_id in job_ids], 1, self.worker_id))  # 1 = Processing
+            
+            self.db_connection.commit()
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.warning(f"Error renewing leases for jobs {job_ids}: {str(e)}")
+
+    def get_job_status(self, job_id):
+        """
+        Retrieve the current status and lease holder of a job
+        """
+        return self.get_job_statuses([job_id]).get(str(job_id))
+
+    def get_job_statuses(self, job_ids):
+        """
+        Retrieve the current status and lease holder of several jobs, keyed by job ID
+        """
+        try:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                SELECT "Id", "Status", "LeasedBy"
+                FROM "AnalysisJobs"
+                WHERE "Id" = ANY(%s::uuid[])
+            """, ([str(job_id) for job_id in job_ids],))
+            
+            rows = cursor.fetchall()
+            # End the read transaction so later writes get a fresh NOW()
+            self.db_connection.commit()
+            return {str(row[0]): {"status": row[1], "leased_by": row[2]} for row in rows}
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.error(f"Error retrieving job status: {str(e)}")
+            return {}
+
+    def retry_later(self, ch, message):
+        """
+        Publish a message to the retry queue; it returns to analysis_jobs after lease_retry_seconds
+        """
+        ch.basic_publish(exchange='', routing_key='analysis_jobs_retry',
+                         body=json.dumps(message),
+                         properties=pika.BasicProperties(delivery_mode=2,  # Persistent
+                                                         expiration=str(self.lease_retry_seconds * 1000)))
+
+    def update_job_preview(self, job_id, results):
+        """
+        Write a provisional result while the job is still Processing
+        """
+        try:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                UPDATE "AnalysisJobs"
+                SET "AnalysisResult" = %s
+                WHERE "Id" = %s AND "Status" = %s AND "LeasedBy" = %s
+            """, (json.dumps(results), str(job_id), 1, self.worker_id))  # 1 = Processing
+            
+            self.db_connection.commit()
+            logger.info(f"Successfully wrote preview result for job {job_id}")
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.error(f"Error writing preview result: {str(e)}")
+
     def update_job_results(self, job_id, results):
         """
         Update job results in the database
@@ -207,8 +934,8 @@ class AIWorker:
         try:
             cursor = self.db_connection.cursor()
             
-            # Convert results to JSON string
-            results_json = json.dumps(results)
+            # Convert results to JSON string, recording which model version produced them
+            results_json = json.dumps({"model_version": self.model_version, **results})
             
             # Update the AnalysisJobs table
             cursor.execute("""
@@ -217,24 +944,67 @@ class AIWorker:
                     "AnalysisResult" = %s,
                     "AnnotatedImageKey" = %s,
                     "CompletedAt" = NOW(),
-                    "ProcessingTimeMs" = EXTRACT(EPOCH FROM (NOW() - "CreatedAt")) * 1000
-                WHERE "Id" = %s
-            """, (2, results_json, results.get("annotated_image_path", ""), str(job_id)))  # 2 = Completed
+                    "ProcessingTimeMs" = EXTRACT(EPOCH FROM (NOW() - "CreatedAt")) * 1000,
+                    "LeasedBy" = NULL,
+                    "LeaseExpiresAt" = NULL
+                WHERE "Id" = %s AND "LeasedBy" = %s
+            """, (2, results_json, results.get("annotated_image_path", ""), str(job_id), self.worker_id))  # 2 = Completed
             
+            updated = cursor.rowcount
             self.db_connection.commit()
+            if updated == 0:
+                logger.warning(f"Lease on job {job_id} was lost before results could be written, discarding results")
+                return
             logger.info(f"Successfully updated job {job_id} with results")
         except Exception as e:
             self.db_connection.rollback()
             logger.error(f"Error updating job results: {str(e)}")
 
+    def update_session_results(self, results):
+        """
+        Write the results of several jobs in a single statement and transaction
+        """
+        if not results:
+            return
+        try:
+            cursor = self.db_connection.cursor()
+            rows = [
+                (str(job_id), json.dumps({"model_version": self.model_version, **job_results}),
+                 job_results.get("annotated_image_path", ""), self.worker_id)
+                for job_id, job_results in results.items()
+            ]
+            psycopg2.extras.execute_values(cursor, """
+                UPDATE "AnalysisJobs" AS aj
+                SET "Status" = 2,
+                    "AnalysisResult" = v.result,
+                    "AnnotatedImageKey" = v.annotated_image_key,
+                    "CompletedAt" = NOW(),
+                    "ProcessingTimeMs" = EXTRACT(EPOCH FROM (NOW() - aj."CreatedAt")) * 1000,
+                    "LeasedBy" = NULL,
+                    "LeaseExpiresAt" = NULL
+                FROM (VALUES %s) AS v(id, result, annotated_image_key, leased_by)
+                WHERE aj."Id" = v.id::uuid AND aj."LeasedBy" = v.leased_by
+            """, rows, page_size=len(rows))  # 2 = Completed; one statement so rowcount covers every row
+            
+            updated = cursor.rowcount
+            self.db_connection.commit()
+            if updated < len(rows):
+                logger.warning(f"Lease lost on {len(rows) - updated} of {len(rows)} session jobs, their results were discarded")
+            logger.info(f"Successfully updated {updated} session jobs with results")
+        except Exception as e:
+            self.db_connection.rollback()
+            logger.error(f"Error updating session results: {str(e)}")
+
     def run_inference(self, image):
         """
         Run ONNX model inference on the image
         """
-        # Preprocess the image for YOLOv8
-        input_shape = (640, 640)  # Standard YOLOv8 input size
-        original_shape = image.shape[:2]
-        
+        return self.run_batch_inference([image])[0]
+
+    def preprocess_image(self, image, input_shape):
+        """
+        Convert a BGR image into a normalized CHW tensor for YOLOv8
+        """
         # Resize image while maintaining aspect ratio
         img_resized = self.resize_and_pad(image, input_shape)
         
@@ -245,19 +1015,44 @@ class AIWorker:
         img_normalized = img_rgb.astype(np.float32) / 255.0
         
         # Change to CHW format (Channels, Height, Width)
-        img_transposed = np.transpose(img_normalized, (2, 0, 1))
-        
-        # Add batch dimension
-        img_batch = np.expand_dims(img_transposed, axis=0)
+        return np.transpose(img_normalized, (2, 0, 1))
+
+    def get_model_input_shape(self, model, default=(640, 640)):
+        """
+        Return the (height, width) a model expects, or the default if its input size is dynamic
+        """
+        height, width = model.get_inputs()[0].shape[2:4]
+        if isinstance(height, int) and isinstance(width, int):
+            return (height, width)
+        return default
+
+    def run_batch_inference(self, images, model=None, input_shape=None):
+        """
+        Run ONNX model inference on several images as one batch.
+        Returns a list of detections per image, in the same order as the input.
+        Defaults to the active model at its manifest input size.
+        """
+        model = model or self.model
+        input_shape = input_shape or self.model_input_shape
         
-        # Run inference
-        ort_inputs = {self.model.get_inputs()[0].name: img_batch}
-        ort_outs = self.model.run(None, ort_inputs)
+        # Stack preprocessed images along the batch dimension
+        img_batch = np.stack([self.preprocess_image(image, input_shape) for image in images])
         
-        # Post-process detections
-        detections = self.post_process_detections(ort_outs, original_shape, input_shape)
+        model_input = model.get_inputs()[0]
+        if isinstance(model_input.shape[0], int) and model_input.shape[0] == 1 and len(images) > 1:
+            # Model was exported with a fixed batch size of 1, run images one at a time
+            output_tensor = np.concatenate([
+                model.run(None, {model_input.name: img_batch[i:i + 1]})[0]
+                for i in range(len(images))
+            ])
+        else:
+            output_tensor = model.run(None, {model_input.name: img_batch})[0]
         
-        return detections
+        # Post-process detections for each image against its own original size
+        return [
+            self.post_process_detections([output_tensor[i:i + 1]], image.shape[:2], input_shape)
+            for i, image in enumerate(images)
+        ]
 
     def resize_and_pad(self, image, target_shape):
         """
@@ -298,9 +1093,9 @@ class AIWorker:
             # Reshape from [1, 4 + num_classes, num_boxes] to [num_boxes, 4 + num_classes]
             output_tensor = output_tensor[0].transpose()
         
-        # Define confidence threshold and NMS threshold
-        conf_threshold = 0.15  # As used in the old script
-        nms_threshold = 0.45   # Standard NMS threshold
+        # Confidence threshold and NMS threshold come from the active model manifest
+        conf_threshold = self.conf_threshold
+        nms_threshold = self.nms_threshold
         
         # Lists to store valid detections
         boxes = []
@@ -381,16 +1176,11 @@ class AIWorker:
 
     def analyze_detections(self, detections, analysis_image, original_image):
         """
-        Analyze detections and calculate all required metrics
+        Analyze detections and calculate all required metrics.
+        Pass analysis_image=None to skip drawing annotations.
         """
-        # Define class names based on the old script
-        class_names = {
-            0: 'single',
-            1: 'double',
-            2: 'triple+',
-            3: 'abnormal',
-            4: 'undersize'
-        }
+        # Class names come from the active model manifest
+        class_names = self.class_names
         
         # Detections that could be part of a healthy follicular unit
         clusterable_detections = []
@@ -519,34 +1309,60 @@ class AIWorker:
             "other_detections": other_detections
         }
 
+    def load_image(self, image_key):
+        """
+        Read an image from storage and decode it, returns None if it cannot be decoded
+        """
+        data = self.storage.read_bytes(image_key)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
     def save_annotated_image(self, analysis_image, job_id):
         """
-        Save the annotated image and return its path
+        Start uploading the annotated image and return its storage key.
+        Call self.storage.flush() before writing the key to the database.
         """
-        # Create annotated images directory if it doesn't exist
-        annotated_dir = os.path.join("output", "annotated_images")
-        if not os.path.exists(annotated_dir):
-            os.makedirs(annotated_dir)
+        ok, encoded = cv2.imencode('.jpg', analysis_image)
+        if not ok:
+            raise Exception(f"Could not encode annotated image for job {job_id}")
         
-        # Save annotated image
-        annotated_path = os.path.join(annotated_dir, f"annotated_{job_id}.jpg")
-        cv2.imwrite(annotated_path, analysis_image)
-        
-        # Return relative path for storage in database
-        return os.path.join("output", "annotated_images", f"annotated_{job_id}.jpg")
+        # Relative key with forward slashes so it is valid for both local and S3 storage
+        annotated_key = f"output/annotated_images/annotated_{job_id}.jpg"
+        self.storage.write_async(annotated_key, encoded.tobytes())
+        return annotated_key
 
     def callback(self, ch, method, properties, body):
         """
         Callback function for RabbitMQ messages
         """
         try:
+            # Pick up a newly loaded model version before starting on this message
+            self.apply_pending_model()
+            
             message = json.loads(body)
             job_id = message.get('JobId')
             
-            if job_id:
+            if message.get('JobIds'):
+                self.handle_session_message(ch, method, message)
+            elif job_id:
                 logger.info(f"Received job {job_id} from queue")
-                # Update job status to Processing
-                self.update_job_status(job_id, 'Processing')
+                # Lease the job before doing any work, so redelivered or duplicate
+                # messages do not re-run the pipeline
+                if not self.claim_job(job_id):
+                    job_status = self.get_job_status(job_id)
+                    if job_status is None:
+                        logger.warning(f"Job {job_id} not found, discarding message")
+                        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                    elif job_status['status'] in (2, 3):  # Completed, Failed
+                        logger.info(f"Job {job_id} already finished (status {job_status['status']}), "
+                                    f"skipping duplicate message")
+                        ch.basic_ack(delivery_tag=method.delivery_tag)
+                    else:
+                        # Leased by another worker that may have crashed; retry until the lease expires
+                        logger.info(f"Job {job_id} is leased by {job_status['leased_by']}, "
+                                    f"retrying in {self.lease_retry_seconds}s")
+                        self.retry_later(ch, message)
+                        ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
                 
                 # Process the job
                 results = self.process_job(job_id)
@@ -564,10 +1380,62 @@ class AIWorker:
         except Exception as e:
             logger.error(f"Error processing job: {str(e)}")
             # Update job status to Failed
-            if 'job_id' in locals():
+            if 'job_id' in locals() and job_id:
                 self.update_job_status(job_id, 'Failed', str(e))
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
 
+    def handle_session_message(self, ch, method, message):
+        """
+        Handle a session message listing several jobs:
+        {"SessionId": "...", "JobIds": ["...", "..."]}
+        """
+        session_id = message.get('SessionId')
+        job_ids = [str(job_id) for job_id in message['JobIds']]
+        logger.info(f"Received session {session_id} with {len(job_ids)} jobs from queue")
+        
+        # Lease all jobs in one statement, skipping ones already completed or held by another worker
+        try:
+            claimed = self.claim_jobs(job_ids)
+        except Exception as e:
+            # Nothing was claimed, so retry the whole message rather than dropping it
+            logger.error(f"Could not claim jobs of session {session_id}, retrying in {self.lease_retry_seconds}s: {str(e)}")
+            self.retry_later(ch, message)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        claimed_job_ids = [job_id for job_id in job_ids if job_id in claimed]
+        unclaimed_job_ids = [job_id for job_id in job_ids if job_id not in claimed_job_ids]
+        if unclaimed_job_ids:
+            # Jobs leased by another (possibly crashed) worker are retried until their lease expires
+            statuses = self.get_job_statuses(unclaimed_job_ids)
+            retry_job_ids = [job_id for job_id in unclaimed_job_ids
+                             if job_id in statuses and statuses[job_id]['status'] not in (2, 3)]  # Completed, Failed
+            if retry_job_ids:
+                logger.info(f"{len(retry_job_ids)} jobs of session {session_id} are leased by other workers, "
+                            f"retrying in {self.lease_retry_seconds}s")
+                self.retry_later(ch, {"SessionId": session_id, "JobIds": retry_job_ids})
+            logger.info(f"Skipping {len(unclaimed_job_ids) - len(retry_job_ids)} jobs of session {session_id} already handled")
+        
+        if not claimed_job_ids:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        
+        try:
+            results, failures = self.process_session(session_id, claimed_job_ids)
+        except Exception as e:
+            logger.error(f"Error processing session {session_id}: {str(e)}")
+            for job_id in claimed_job_ids:
+                self.update_job_status(job_id, 'Failed', str(e))
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        
+        # Update database with all region results at once
+        self.update_session_results(results)
+        for job_id, error_message in failures.items():
+            self.update_job_status(job_id, 'Failed', error_message)
+        
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        logger.info(f"Processed session {session_id}")
+
     def update_job_status(self, job_id, status, error_message=None):
         """
         Update job status in the database
@@ -592,13 +1460,16 @@ class AIWorker:
                     WHERE "Id" = %s
                 """, (status_int, str(job_id)))
             elif status == 'Failed':
+                # Only fail jobs this worker holds (or that were never leased)
                 cursor.execute("""
                     UPDATE "AnalysisJobs" 
                     SET "Status" = %s, 
                         "ErrorMessage" = %s,
-                        "CompletedAt" = NOW()
-                    WHERE "Id" = %s
-                """, (status_int, error_message, str(job_id)))
+                        "CompletedAt" = NOW(),
+                        "LeasedBy" = NULL,
+                        "LeaseExpiresAt" = NULL
+                    WHERE "Id" = %s AND ("LeasedBy" IS NULL OR "LeasedBy" = %s)
+                """, (status_int, error_message, str(job_id), self.worker_id))
             elif status == 'Completed':
                 cursor.execute("""
                     UPDATE "AnalysisJobs" 
@@ -622,10 +1493,45 @@ class AIWorker:
             logger.error("Worker not properly initialized. Missing environment variables.")
             return
             
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(queue='analysis_jobs', on_message_callback=self.callback)
+        # The message being processed plus the ones delivered ahead of it for read-ahead
+        self.channel.basic_qos(prefetch_count=1 + self.prefetch_messages)
+        self.channel.basic_consume(queue='analysis_jobs', on_message_callback=self.enqueue_message)
         logger.info("AI Worker is waiting for messages. To exit press CTRL+C")
-        self.channel.start_consuming()
+        
+        while True:
+            if not self.pending_messages:
+                # Block briefly until RabbitMQ delivers something
+                self.connection.process_data_events(time_limit=1)
+                continue
+            
+            # Pull in any other prefetched deliveries and read their images ahead
+            self.connection.process_data_events(time_limit=0)
+            ch, method, properties, body = self.pending_messages.popleft()
+            self.prefetch_images([message[3] for message in self.pending_messages])
+            self.callback(ch, method, properties, body)
+
+    def enqueue_message(self, ch, method, properties, body):
+        """
+        Consumer callback: buffer the delivery so images of queued jobs can be read ahead
+        """
+        self.pending_messages.append((ch, method, properties, body))
+
+    def prefetch_images(self, bodies):
+        """
+        Start reading the images of queued (not yet processed) messages into the local cache
+        """
+        if not self.storage.cache_dir or not bodies:
+            return
+        job_ids = []
+        for body in bodies:
+            try:
+                message = json.loads(body)
+            except ValueError:
+                continue
+            job_ids.extend(str(job_id) for job_id in message.get('JobIds') or [message.get('JobId')] if job_id)
+        if job_ids:
+            jobs = self.get_session_job_details(job_ids)
+            self.storage.prefetch([job['image_path'] for job in jobs.values()])
     
     def stop(self):
         """
@@ -66,6 +66,19 @@ public class GetAnalysisJobResultQueryHandler : IRequestHandler<GetAnalysisJobRe
             };
         }
 
+        // The AI worker writes a fast preview result while the refined pass is still running
+        if (job.Status == JobStatus.Processing && !string.IsNullOrEmpty(job.AnalysisResult))
+        {
+            return new GetAnalysisJobResultQueryResponse
+            {
+                Success = true,
+                Message = "Provisional analysis result retrieved successfully",
+                AnalysisResult = job.AnalysisResult,
+                DoctorNotes = job.DoctorNotes,
+                IsProvisional = true
+            };
+        }
+
         if (job.Status != JobStatus.Completed)
         {
             return new GetAnalysisJobResultQueryResponse
@@ -10,4 +10,5 @@ public class GetAnalysisJobResultQueryResponse
     public string? AnalysisResult { get; set; }
     public string? AnnotatedImageKey { get; set; }
     public string? DoctorNotes { get; set; }
+    public bool IsProvisional { get; set; }
 }
\ No newline at end of file
@@ -42,6 +42,12 @@ public class AnalysisJob
 
     public int? ProcessingTimeMs { get; set; }
 
+    // Job lease held by the AI worker currently processing this job
+    [StringLength(100)]
+    public string? LeasedBy { get; set; }
+
+    public DateTime? LeaseExpiresAt { get; set; }
+
     // Navigation properties
     public AnalysisSession Session { get; set; } = null!;
     public Patient Patient { get; set; } = null!;
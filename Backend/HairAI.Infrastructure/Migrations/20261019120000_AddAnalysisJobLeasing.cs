@@ -0,0 +1,45 @@
+using System;
+using HairAI.Infrastructure.Persistence;
+using Microsoft.EntityFrameworkCore.Infrastructure;
+using Microsoft.EntityFrameworkCore.Migrations;
+
+#nullable disable
+
+namespace HairAI.Infrastructure.Migrations
+{
+    /// <inheritdoc />
+    [DbContext(typeof(ApplicationDbContext))]
+    [Migration("20261019120000_AddAnalysisJobLeasing")]
+    public partial class AddAnalysisJobLeasing : Migration
+    {
+        /// <inheritdoc />
+        protected override void Up(MigrationBuilder migrationBuilder)
+        {
+            // Worker ID and expiry of the lease taken by the AI worker when it claims a job
+            migrationBuilder.AddColumn<string>(
+                name: "LeasedBy",
+                table: "AnalysisJobs",
+                type: "character varying(100)",
+                maxLength: 100,
+                nullable: true);
+
+            migrationBuilder.AddColumn<DateTime>(
+                name: "LeaseExpiresAt",
+                table: "AnalysisJobs",
+                type: "timestamp with time zone",
+                nullable: true);
+        }
+
+        /// <inheritdoc />
+        protected override void Down(MigrationBuilder migrationBuilder)
+        {
+            migrationBuilder.DropColumn(
+                name: "LeasedBy",
+                table: "AnalysisJobs");
+
+            migrationBuilder.DropColumn(
+                name: "LeaseExpiresAt",
+                table: "AnalysisJobs");
+        }
+    }
+}